@@ -1,23 +1,35 @@
 from fastapi import FastAPI, Request, HTTPException, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from pydantic import BaseModel, validator
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, StringConstraints, field_validator
+from typing import Annotated, List, Optional, Dict, Any, Tuple
 import os
 import time
 import logging
 import structlog
 import hashlib
-import json
-from datetime import datetime, timedelta
+import orjson
+from cachetools import TTLCache
+from datetime import datetime
 import asyncio
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # Import our utilities
-from utils.document_loader import download_and_parse_document, DocumentLoadError
-from utils.chunker import chunk_text, validate_chunks
-from utils.embedder import embed_chunks, embed_query
+from utils.document_loader import iter_document_text, get_document_version, DocumentLoadError
+from utils.chunker import iter_chunks, validate_chunks
+from utils.embedder import embed_batch, embed_queries, get_model, warm_up_model, iter_batches, EMBED_SORT_WINDOW
 from utils.faiss_index import build_faiss_index, retrieve_top_k_chunks
-from utils.llm import generate_answer, LLMError
+from utils.llm import generate_answer_with_retry, LLMError
+from utils.cache import TwoTierCache, SemanticCache, DocumentCache, close_redis
 
 # Configure structured logging
 structlog.configure(
@@ -30,7 +42,8 @@ structlog.configure(
         structlog.processors.StackInfoRenderer(),
         structlog.processors.format_exc_info,
         structlog.processors.UnicodeDecoder(),
-        structlog.processors.JSONRenderer()
+        # orjson returns bytes; stdlib logging handlers expect str
+        structlog.processors.JSONRenderer(serializer=lambda obj, **kw: orjson.dumps(obj, **kw).decode())
     ],
     context_class=dict,
     logger_factory=structlog.stdlib.LoggerFactory(),
@@ -61,33 +74,36 @@ API_TOKEN = os.getenv("API_TOKEN", "your_token_here")
 MAX_DOCUMENT_SIZE = 50 * 1024 * 1024  # 50MB
 MAX_QUESTIONS = 10
 MAX_TEXT_LENGTH = 1000000  # 1MB text limit
+# Worker processes for parsing, chunking and embedding (0 runs them on threads instead)
+PROCESS_POOL_WORKERS = int(os.getenv("PROCESS_POOL_WORKERS", os.cpu_count() or 1))
+PIPELINE_QUEUE_SIZE = 2 * EMBED_SORT_WINDOW  # Chunks parsed ahead of the embedder
 
-# Simple in-memory cache (for Vercel, consider Redis for production)
-cache: Dict[str, Any] = {}
+# Response cache: per-instance TTL cache, shared across instances via Redis when REDIS_URL is set
 CACHE_TTL = 3600  # 1 hour
+cache = TwoTierCache(ttl=CACHE_TTL)
+# Answers to near-duplicate questions on the same document are reused from here
+semantic_cache = SemanticCache(ttl=CACHE_TTL)
+# Chunks and search index per document, so repeat documents skip download and embedding
+document_cache = DocumentCache()
+# Current ETag / Last-Modified per document URL, re-checked with a HEAD request after this long
+DOCUMENT_VERSION_TTL = 300
+document_versions = TTLCache(maxsize=1024, ttl=DOCUMENT_VERSION_TTL)
+
+# Stripping and per-question checks run inside pydantic-core rather than a Python loop
+Question = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
 
 class QueryRequest(BaseModel):
-    documents: str
-    questions: List[str]
+    documents: Annotated[str, StringConstraints(strip_whitespace=True)]
+    questions: Annotated[List[Question], Field(min_length=1, max_length=MAX_QUESTIONS)]
     
-    @validator('documents')
+    @field_validator('documents')
+    @classmethod
     def validate_documents(cls, v):
-        if not v or not v.strip():
+        if not v:
             raise ValueError("Document URL cannot be empty")
         if not v.startswith(('http://', 'https://')):
             raise ValueError("Document URL must start with http:// or https://")
-        return v.strip()
-    
-    @validator('questions')
-    def validate_questions(cls, v):
-        if not v:
-            raise ValueError("At least one question is required")
-        if len(v) > MAX_QUESTIONS:
-            raise ValueError(f"Maximum {MAX_QUESTIONS} questions allowed")
-        for i, question in enumerate(v):
-            if not question or not question.strip():
-                raise ValueError(f"Question {i+1} cannot be empty")
-        return [q.strip() for q in v]
+        return v
 
 class QueryResponse(BaseModel):
     answers: List[str]
@@ -107,40 +123,156 @@ def check_token(auth_header: Optional[str] = Header(None)):
     if token != API_TOKEN:
         raise HTTPException(status_code=403, detail="Invalid token")
 
-def get_cache_key(documents: str, questions: List[str]) -> str:
+def get_cache_key(doc_key: str, questions: List[str]) -> str:
     """Generate cache key for request"""
-    content = f"{documents}:{json.dumps(questions, sort_keys=True)}"
-    return hashlib.md5(content.encode()).hexdigest()
-
-def is_cache_valid(cache_entry: Dict[str, Any]) -> bool:
-    """Check if cache entry is still valid"""
-    if 'timestamp' not in cache_entry:
-        return False
-    cache_time = datetime.fromisoformat(cache_entry['timestamp'])
-    return datetime.now() - cache_time < timedelta(seconds=CACHE_TTL)
-
-def cleanup_cache():
-    """Remove expired cache entries"""
-    global cache
-    current_time = datetime.now()
-    expired_keys = []
+    # Feed raw bytes straight into the hash; NUL separators keep question boundaries unambiguous
+    hasher = blake3.blake3() if blake3 else hashlib.md5()
+    hasher.update(doc_key.encode())
+    for question in questions:
+        hasher.update(b'\0')
+        hasher.update(question.encode())
+    return hasher.hexdigest(16) if blake3 else hasher.hexdigest()
+
+async def run_blocking(func, *args):
+    """Run a blocking function in the default thread pool so the event loop stays free"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+async def get_document_key(documents: str) -> str:
+    """Generate cache key for a document URL and its current version (ETag or Last-Modified)"""
+    # A changed document gets a new key, so cached chunks, index and answers are never stale
+    version = document_versions.get(documents)
+    if version is None:
+        version = await run_blocking(get_document_version, documents) or ""
+        document_versions[documents] = version
+    return hashlib.sha256(f"{documents}\0{version}".encode()).hexdigest()
+
+def create_process_pool() -> ProcessPoolExecutor:
+    """Create the worker pool; each worker loads the embedding model up front"""
+    # spawn rather than fork, since torch is already imported in this process
+    return ProcessPoolExecutor(
+        max_workers=PROCESS_POOL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=get_model
+    )
+
+async def run_cpu_bound(func, *args):
+    """Run a CPU-heavy function in the process pool, so it neither holds the GIL nor blocks the event loop"""
+    pool = getattr(app.state, "pool", None)
+    if pool is None:
+        return await run_blocking(func, *args)
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed on a huge document) and the pool refuses all further
+        # work; replace it so only this request fails. Concurrent failures replace it once
+        if app.state.pool is pool:
+            logger.error("Process pool broken, restarting it")
+            pool.shutdown(wait=False, cancel_futures=True)
+            app.state.pool = create_process_pool()
+        raise
+
+async def answer_question(index: int, total: int, question: str, context: str) -> Tuple[str, bool]:
+    """Generate the answer for a single question off the event loop, and whether the LLM call succeeded"""
+    logger.info(f"Processing question {index+1}/{total}", question=question)
+    try:
+        answer = await run_blocking(generate_answer_with_retry, question, context)
+        logger.info(f"Generated answer for question {index+1}", answer_length=len(answer))
+        return answer, True
+    except Exception as e:
+        logger.error(f"Failed to process question {index+1}", error=str(e))
+        return f"I apologize, but I encountered an error while processing this question: {str(e)}", False
+
+def limit_text_length(segments):
+    """Pass document text segments through, failing once the text exceeds MAX_TEXT_LENGTH"""
+    text_length = 0
+    for segment in segments:
+        text_length += len(segment)
+        if text_length > MAX_TEXT_LENGTH:
+            # Raised in a pool worker, so it must survive pickling (HTTPException does not)
+            raise DocumentLoadError(f"Document too large. Maximum {MAX_TEXT_LENGTH} characters allowed.")
+        yield segment
+
+def iter_in_background(iterable, maxsize: int = PIPELINE_QUEUE_SIZE):
+    """Run a blocking iterable on a background thread, buffering at most maxsize items ahead of the consumer"""
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+    done = object()
     
-    for key, entry in cache.items():
-        if 'timestamp' in entry:
-            cache_time = datetime.fromisoformat(entry['timestamp'])
-            if current_time - cache_time >= timedelta(seconds=CACHE_TTL):
-                expired_keys.append(key)
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+                if stopped.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+        finally:
+            # Release the source (HTTP response, temp file) as soon as the pipeline ends; a
+            # generator can only be closed from the thread running it, so this happens here
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
     
-    for key in expired_keys:
-        del cache[key]
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        # If the consumer gave up early, empty the queue so a producer blocked in put() wakes,
+        # sees stopped and exits; it puts at most once more, and that always fits
+        stopped.set()
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
+
+def process_document(documents: str):
+    """Download, parse, chunk and embed a document, embedding early chunks while later pages are still parsed"""
+    # Parsing and chunking run on a background thread; the model releases the GIL while encoding
+    segments = limit_text_length(iter_document_text(documents))
+    chunks = []
+    embeddings = []
+    for batch in iter_batches(iter_in_background(iter_chunks(segments)), EMBED_SORT_WINDOW):
+        batch = validate_chunks(batch)
+        if batch:
+            chunks.extend(batch)
+            embeddings.extend(embed_batch(batch))
+    return chunks, embeddings
+
+async def get_doc_artifacts(documents: str, doc_key: str):
+    """Get chunks and search index for a document, processing it only on a cache miss"""
+    artifacts = await document_cache.get(doc_key)
+    if artifacts is not None:
+        logger.info("Using cached document artifacts", url=documents)
+        return artifacts
+    
+    # Download, parse, chunk and embed the document as one pipeline (streamed page by page)
+    logger.info("Starting document processing", url=documents)
+    chunks, chunk_embeddings = await run_cpu_bound(process_document, documents)
     
-    if expired_keys:
-        logger.info(f"Cleaned up {len(expired_keys)} expired cache entries")
+    if not chunks:
+        raise DocumentLoadError("No valid text content could be extracted from the document")
+    
+    logger.info("Embedded chunks", num_chunks=len(chunks))
+    # Stacking and normalizing the matrix is one numpy pass, so a thread is enough
+    faiss_index = await run_blocking(build_faiss_index, chunk_embeddings)
+    
+    await document_cache.set(doc_key, chunks, faiss_index)
+    return chunks, faiss_index
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     """Log all requests and responses"""
-    start_time = time.time()
+    start_time = time.perf_counter()
     
     # Log request
     logger.info(
@@ -154,7 +286,7 @@ async def log_requests(request: Request, call_next):
         response = await call_next(request)
         
         # Log response
-        process_time = time.time() - start_time
+        process_time = time.perf_counter() - start_time
         logger.info(
             "Request completed",
             status_code=response.status_code,
@@ -164,7 +296,7 @@ async def log_requests(request: Request, call_next):
         return response
     except Exception as e:
         # Log error
-        process_time = time.time() - start_time
+        process_time = time.perf_counter() - start_time
         logger.error(
             "Request failed",
             error=str(e),
@@ -197,7 +329,6 @@ async def root():
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint with cache status"""
-    cleanup_cache()
     return HealthResponse(
         status="healthy",
         timestamp=datetime.now().isoformat(),
@@ -221,68 +352,57 @@ async def hackrx_run(
     check_token(authorization)
     
     # Check cache first
-    cache_key = get_cache_key(req.documents, req.questions)
-    if cache_key in cache and is_cache_valid(cache[cache_key]):
+    doc_key = await get_document_key(req.documents)
+    cache_key = get_cache_key(doc_key, req.questions)
+    cached_response = await cache.get(cache_key)
+    if cached_response is not None:
         logger.info("Returning cached response", cache_key=cache_key)
-        return QueryResponse(**cache[cache_key]['response'])
+        return QueryResponse(**cached_response)
     
-    start_time = time.time()
+    start_time = time.perf_counter()
     
     try:
-        # Step 1: Download and parse document
-        logger.info("Starting document processing", url=req.documents)
-        text = download_and_parse_document(req.documents)
-        
-        if len(text) > MAX_TEXT_LENGTH:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Document too large. Maximum {MAX_TEXT_LENGTH} characters allowed."
-            )
-        
-        # Step 2: Chunk and embed
-        logger.info("Chunking document", text_length=len(text))
-        chunks = chunk_text(text)
-        chunks = validate_chunks(chunks)
+        # Step 1-2: Download, parse, chunk and embed the document (cached per URL and version)
+        chunks, faiss_index = await get_doc_artifacts(req.documents, doc_key)
         
-        if not chunks:
-            raise HTTPException(
-                status_code=400,
-                detail="No valid text content could be extracted from the document"
-            )
+        # Step 3: Embed all questions in one batch and retrieve context for all of them at once
+        q_embeddings = await run_cpu_bound(embed_queries, req.questions)
+        top_chunks_per_question = retrieve_top_k_chunks(faiss_index, q_embeddings, chunks)
         
-        logger.info("Embedding chunks", num_chunks=len(chunks))
-        chunk_embeddings = embed_chunks(chunks)
-        faiss_index = build_faiss_index(chunk_embeddings)
+        # Step 4: Reuse answers to near-duplicate questions already asked about this document
+        answers = await semantic_cache.lookup(doc_key, q_embeddings)
+        misses = [i for i, answer in enumerate(answers) if answer is None]
         
-        # Step 3: Process each question
-        answers = []
         metadata = {
             "document_url": req.documents,
             "num_questions": len(req.questions),
             "num_chunks": len(chunks),
             "processing_time": 0,
-            "cache_hit": False
+            "cache_hit": False,
+            "semantic_cache_hits": len(answers) - len(misses)
         }
         
-        for i, question in enumerate(req.questions):
-            logger.info(f"Processing question {i+1}/{len(req.questions)}", question=question)
-            
-            try:
-                q_embedding = embed_query(question)
-                top_chunks = retrieve_top_k_chunks(faiss_index, q_embedding, chunks)
-                context = " ".join(top_chunks)
-                
-                answer = generate_answer(question, context)
-                answers.append(answer)
-                
-                logger.info(f"Generated answer for question {i+1}", answer_length=len(answer))
-                
-            except Exception as e:
-                logger.error(f"Failed to process question {i+1}", error=str(e))
-                answers.append(f"I apologize, but I encountered an error while processing this question: {str(e)}")
+        # Step 5: Answer the remaining questions concurrently (gather preserves question order)
+        results = await asyncio.gather(*[
+            answer_question(i, len(req.questions), req.questions[i], " ".join(top_chunks_per_question[i]))
+            for i in misses
+        ])
+        answered = []
+        for i, (answer, ok) in zip(misses, results):
+            answers[i] = answer
+            if ok:
+                answered.append(i)
+        
+        # Only cache real answers; questions whose LLM call failed are retried on the next request
+        await semantic_cache.add(
+            doc_key,
+            [req.questions[i] for i in answered],
+            [q_embeddings[i] for i in answered],
+            [answers[i] for i in answered]
+        )
         
         # Calculate processing time
-        processing_time = time.time() - start_time
+        processing_time = time.perf_counter() - start_time
         metadata["processing_time"] = processing_time
         
         # Create response
@@ -291,11 +411,9 @@ async def hackrx_run(
             "metadata": metadata
         }
         
-        # Cache the response
-        cache[cache_key] = {
-            "response": response_data,
-            "timestamp": datetime.now().isoformat()
-        }
+        # Cache the response, unless it carries error messages in place of answers
+        if len(answered) == len(misses):
+            await cache.set(cache_key, response_data)
         
         logger.info(
             "Request completed successfully",
@@ -305,6 +423,9 @@ async def hackrx_run(
         
         return QueryResponse(**response_data)
         
+    except HTTPException:
+        raise
+    
     except DocumentLoadError as e:
         logger.error("Document loading failed", error=str(e))
         raise HTTPException(status_code=400, detail=f"Document processing failed: {str(e)}")
@@ -321,9 +442,9 @@ async def hackrx_run(
 async def clear_cache(authorization: Optional[str] = Header(None)):
     """Clear the cache"""
     check_token(authorization)
-    global cache
-    cache_size = len(cache)
-    cache.clear()
+    cache_size = await cache.clear()
+    await semantic_cache.clear()
+    await document_cache.clear()
     logger.info("Cache cleared", cache_size=cache_size)
     return {"message": f"Cache cleared. Removed {cache_size} entries."}
 
@@ -331,9 +452,10 @@ async def clear_cache(authorization: Optional[str] = Header(None)):
 async def cache_stats(authorization: Optional[str] = Header(None)):
     """Get cache statistics"""
     check_token(authorization)
-    cleanup_cache()
     return {
         "cache_size": len(cache),
+        "semantic_cache_documents": len(semantic_cache),
+        "document_cache_size": len(document_cache),
         "cache_ttl": CACHE_TTL,
         "max_document_size": MAX_DOCUMENT_SIZE,
         "max_questions": MAX_QUESTIONS
@@ -353,10 +475,30 @@ async def startup_event():
     gemini_key = os.getenv("GEMINI_API_KEY")
     if not gemini_key:
         logger.warning("GEMINI_API_KEY not set - LLM will use fallback mode")
+    
+    # Start worker processes; without them (e.g. no POSIX semaphores on serverless
+    # platforms) document processing runs on threads instead
+    if PROCESS_POOL_WORKERS > 0:
+        try:
+            app.state.pool = create_process_pool()
+            logger.info("Process pool started", workers=PROCESS_POOL_WORKERS)
+        except Exception as e:
+            logger.warning("Process pool unavailable, using threads", error=str(e))
+    
+    # Workers are spawned one per submitted task while none is idle, and each loads the model in
+    # its get_model initializer before taking work; one no-op per worker starts them all now, so
+    # the first request pays neither process start nor model load
+    if getattr(app.state, "pool", None) is not None:
+        await asyncio.gather(*[run_cpu_bound(os.getpid) for _ in range(PROCESS_POOL_WORKERS)])
+    loaded = await run_cpu_bound(warm_up_model)
+    logger.info("Embedding model warmed up", model_loaded=loaded)
 
 # Shutdown event
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("HackRx 6.0 API shutting down")
-    cleanup_cache() 
\ No newline at end of file
+    pool = getattr(app.state, "pool", None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    await close_redis() 
\ No newline at end of file
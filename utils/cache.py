@@ -0,0 +1,311 @@
+import os
+import time
+import zlib
+import asyncio
+import logging
+from typing import Any, List, Optional, Tuple
+from cachetools import TTLCache
+import numpy as np
+import orjson
+from utils.faiss_index import serialize_index, deserialize_index, save_index, load_index
+from utils.embedder import HASHED_EMBED_DIM
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# Shared L2 cache is only enabled when a Redis URL is configured
+REDIS_URL = os.getenv("REDIS_URL")
+
+CACHE_PREFIX = "hackrx:"
+SEMANTIC_CACHE_THRESHOLD = 0.93  # Cosine similarity above which a cached answer is reused
+DOCUMENT_CACHE_TTL = 24 * 3600  # Processed documents are reused for 24 hours
+# Processed documents are also written here when set, so every worker on the host can mmap them
+DOCUMENT_CACHE_DIR = os.getenv("DOCUMENT_CACHE_DIR")
+
+def create_redis():
+    """Create the shared Redis client, or None when Redis is not configured"""
+    if not REDIS_URL:
+        return None
+    if aioredis is None:
+        logger.warning("REDIS_URL is set but redis is not installed - using in-process cache only")
+        return None
+    logger.info("Redis L2 cache enabled")
+    return aioredis.from_url(REDIS_URL)
+
+redis_client = create_redis()
+
+async def clear_redis_prefix(prefix: str):
+    """Delete every Redis key under the given prefix"""
+    if redis_client is None:
+        return
+    try:
+        keys = [key async for key in redis_client.scan_iter(match=prefix + "*")]
+        if keys:
+            await redis_client.delete(*keys)
+    except Exception as e:
+        logger.warning(f"Redis clear failed: {e}")
+
+class TwoTierCache:
+    """In-process TTL cache (L1) in front of an optional Redis cache (L2)"""
+
+    def __init__(self, ttl: int, maxsize: int = 1024, prefix: str = CACHE_PREFIX + "resp:"):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis_client
+
+    def __len__(self) -> int:
+        # Drops expired entries from the head of the TTL list only
+        self.local.expire()
+        return len(self.local)
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Look up key in L1, then L2; an L2 hit is promoted into L1"""
+        value = self.local.get(key)
+        if value is not None or self.redis is None:
+            return value
+        try:
+            raw = await self.redis.get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f"Redis get failed: {e}")
+            return None
+        if raw is None:
+            return None
+        value = orjson.loads(raw)
+        self.local[key] = value
+        return value
+
+    async def set(self, key: str, value: Any):
+        """Store value in both tiers with the cache TTL"""
+        self.local[key] = value
+        if self.redis is None:
+            return
+        try:
+            await self.redis.setex(self.prefix + key, self.ttl, orjson.dumps(value))
+        except Exception as e:
+            logger.warning(f"Redis set failed: {e}")
+
+    async def clear(self) -> int:
+        """Clear both tiers and return the number of local entries removed"""
+        size = len(self)
+        self.local.clear()
+        await clear_redis_prefix(self.prefix)
+        return size
+
+
+class SemanticCache:
+    """Per-document cache of answered questions, matched by embedding cosine similarity"""
+
+    def __init__(self, ttl: int, maxsize: int = 256, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 prefix: str = CACHE_PREFIX + "sem:"):
+        self.ttl = ttl
+        self.threshold = threshold
+        self.prefix = prefix
+        # document key -> (normalized question embeddings (M, d), answers)
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis_client
+
+    def __len__(self) -> int:
+        self.local.expire()
+        return len(self.local)
+
+    async def load(self, doc_key: str):
+        """Get the cached entries for a document from L1, falling back to Redis"""
+        entry = self.local.get(doc_key)
+        if entry is not None or self.redis is None:
+            return entry
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hgetall(self.prefix + doc_key + ":emb")
+            pipe.hgetall(self.prefix + doc_key + ":ans")
+            embeddings, answers = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis semantic cache load failed: {e}")
+            return None
+        questions = [q for q in embeddings if q in answers]
+        if not questions:
+            return None
+        entry = (
+            np.vstack([np.frombuffer(embeddings[q], dtype=np.float32) for q in questions]),
+            [answers[q].decode() for q in questions]
+        )
+        self.local[doc_key] = entry
+        return entry
+
+    async def lookup(self, doc_key: str, query_embeddings) -> List[Optional[str]]:
+        """Return the cached answer for each query, or None where there is no close match"""
+        results = [None] * len(query_embeddings)
+        # Hashed bag-of-words fallbacks score questions that differ in one key word (maternity
+        # vs dental) above the threshold, so only model embeddings are matched
+        if query_embeddings.shape[1] == HASHED_EMBED_DIM:
+            return results
+        entry = await self.load(doc_key)
+        if entry is None:
+            return results
+        matrix, answers = entry
+        try:
+            scores = query_embeddings @ matrix.T
+        except ValueError as e:
+            logger.warning(f"Semantic cache lookup skipped: {e}")
+            return results
+        best = scores.argmax(axis=1)
+        for i, j in enumerate(best):
+            if scores[i, j] > self.threshold:
+                results[i] = answers[j]
+        return results
+
+    async def add(self, doc_key: str, questions: List[str], query_embeddings, answers: List[str]):
+        """Remember answers for the given questions of a document"""
+        if not questions or len(query_embeddings[0]) == HASHED_EMBED_DIM:
+            return
+        embeddings = np.ascontiguousarray(np.vstack(query_embeddings), dtype=np.float32)
+        entry = self.local.get(doc_key)
+        if entry is not None and entry[0].shape[1] == embeddings.shape[1]:
+            entry = (np.vstack([entry[0], embeddings]), entry[1] + list(answers))
+        else:
+            entry = (embeddings, list(answers))
+        self.local[doc_key] = entry
+        if self.redis is None:
+            return
+        try:
+            emb_key = self.prefix + doc_key + ":emb"
+            ans_key = self.prefix + doc_key + ":ans"
+            pipe = self.redis.pipeline()
+            pipe.hset(emb_key, mapping={q: e.tobytes() for q, e in zip(questions, embeddings)})
+            pipe.hset(ans_key, mapping=dict(zip(questions, answers)))
+            pipe.expire(emb_key, self.ttl)
+            pipe.expire(ans_key, self.ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis semantic cache store failed: {e}")
+
+    async def clear(self) -> int:
+        """Clear both tiers and return the number of local documents removed"""
+        size = len(self)
+        self.local.clear()
+        await clear_redis_prefix(self.prefix)
+        return size
+
+class DocumentCache:
+    """Cache of processed documents (chunks and search index) in L1, an optional disk tier and an optional Redis L2"""
+
+    def __init__(self, ttl: int = DOCUMENT_CACHE_TTL, maxsize: int = 16, prefix: str = CACHE_PREFIX + "doc:",
+                 directory: Optional[str] = DOCUMENT_CACHE_DIR):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.redis = redis_client
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        self.local.expire()
+        return len(self.local)
+
+    def disk_paths(self, doc_key: str) -> Tuple[str, str]:
+        """Chunk and index file paths for a document in the disk tier"""
+        base = os.path.join(self.directory, doc_key)
+        return base + ".chunks", base + ".index"
+
+    def load_from_disk(self, doc_key: str) -> Optional[Tuple[List[str], Any]]:
+        """Read a document from the disk tier, memory-mapping its index"""
+        chunks_path, index_path = self.disk_paths(doc_key)
+        try:
+            if time.time() - os.path.getmtime(chunks_path) > self.ttl:
+                return None
+            with open(chunks_path, 'rb') as f:
+                chunks = orjson.loads(zlib.decompress(f.read()))
+            return chunks, load_index(index_path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Disk document cache load failed: {e}")
+            return None
+
+    def save_to_disk(self, doc_key: str, chunks: List[str], index: Any):
+        """Write a document to the disk tier"""
+        chunks_path, index_path = self.disk_paths(doc_key)
+        # Write temporary files and rename them, so other workers never read a partial entry.
+        # The index goes first, so a visible chunks file always has its index
+        suffix = f".{os.getpid()}.tmp"
+        try:
+            save_index(index, index_path + suffix)
+            with open(chunks_path + suffix, 'wb') as f:
+                f.write(zlib.compress(orjson.dumps(chunks), 1))
+            os.replace(index_path + suffix, index_path)
+            os.replace(chunks_path + suffix, chunks_path)
+        except Exception as e:
+            logger.warning(f"Disk document cache store failed: {e}")
+
+    def clear_disk(self):
+        """Delete every document in the disk tier"""
+        for name in os.listdir(self.directory):
+            if name.endswith((".chunks", ".index", ".tmp")):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as e:
+                    logger.warning(f"Disk document cache clear failed: {e}")
+
+    async def get(self, doc_key: str) -> Optional[Tuple[List[str], Any]]:
+        """Return (chunks, index) for a document, or None on a miss"""
+        artifacts = self.local.get(doc_key)
+        if artifacts is not None:
+            return artifacts
+        if self.directory:
+            artifacts = await asyncio.to_thread(self.load_from_disk, doc_key)
+            if artifacts is not None:
+                self.local[doc_key] = artifacts
+                return artifacts
+        if self.redis is None:
+            return None
+        try:
+            pipe = self.redis.pipeline()
+            pipe.get(self.prefix + doc_key + ":chunks")
+            pipe.get(self.prefix + doc_key + ":index")
+            raw_chunks, raw_index = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis document cache load failed: {e}")
+            return None
+        if raw_chunks is None or raw_index is None:
+            return None
+        artifacts = (
+            orjson.loads(zlib.decompress(raw_chunks)),
+            deserialize_index(raw_index)
+        )
+        self.local[doc_key] = artifacts
+        return artifacts
+
+    async def set(self, doc_key: str, chunks: List[str], index: Any):
+        """Store the processed document in every enabled tier"""
+        self.local[doc_key] = (chunks, index)
+        if self.directory:
+            await asyncio.to_thread(self.save_to_disk, doc_key, chunks, index)
+        if self.redis is None:
+            return
+        raw_index = serialize_index(index)
+        try:
+            pipe = self.redis.pipeline()
+            pipe.setex(self.prefix + doc_key + ":chunks", self.ttl, zlib.compress(orjson.dumps(chunks), 1))
+            pipe.setex(self.prefix + doc_key + ":index", self.ttl, raw_index)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis document cache store failed: {e}")
+
+    async def clear(self) -> int:
+        """Clear every tier and return the number of local documents removed"""
+        size = len(self)
+        self.local.clear()
+        if self.directory:
+            await asyncio.to_thread(self.clear_disk)
+        await clear_redis_prefix(self.prefix)
+        return size
+
+async def close_redis():
+    """Close the shared Redis connection pool"""
+    if redis_client is not None:
+        await redis_client.aclose()
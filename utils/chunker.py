@@ -1,99 +1,135 @@
 import re
 import logging
-from typing import List
+from itertools import accumulate, chain
+from typing import Iterable, Iterator, List
 
 logger = logging.getLogger(__name__)
 
+# Special characters that might interfere with chunking
+SPECIAL_CHARS_RE = re.compile(r'[^\w\s\.\,\!\?\;\:\-\(\)\[\]\{\}]')
+# The same filter as a str.translate table, for the common pure-ASCII case
+ASCII_SPECIAL_CHARS = {c: ' ' for c in range(128) if SPECIAL_CHARS_RE.match(chr(c))}
+# In cleaned (single-spaced) text a sentence ends at a terminator followed by a space
+SENTENCE_END_RE = re.compile(r'[.!?] ')
+
 def clean_text(text: str) -> str:
     """Clean and normalize text for better chunking"""
-    # Remove excessive whitespace
-    text = re.sub(r'\s+', ' ', text)
     # Remove special characters that might interfere with chunking
-    text = re.sub(r'[^\w\s\.\,\!\?\;\:\-\(\)\[\]\{\}]', ' ', text)
-    return text.strip()
-
-def split_into_sentences(text: str) -> List[str]:
-    """Split text into sentences using regex"""
-    # Split on sentence endings, but preserve abbreviations
-    sentences = re.split(r'(?<=[.!?])\s+', text)
-    return [s.strip() for s in sentences if s.strip()]
+    if text.isascii():
+        text = text.translate(ASCII_SPECIAL_CHARS)
+    else:
+        text = SPECIAL_CHARS_RE.sub(' ', text)
+    # Collapse all whitespace runs to single spaces (str.split/join run at C speed)
+    return " ".join(text.split())
 
 def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
     """Enhanced text chunking with semantic boundaries"""
     if not text or not text.strip():
         logger.warning("Empty text provided for chunking")
         return []
-    
-    # Clean the text
-    text = clean_text(text)
-    
-    # Try sentence-based chunking first
-    sentences = split_into_sentences(text)
-    
-    if len(sentences) <= 1:
-        # Fallback to word-based chunking
-        logger.info("Using word-based chunking")
-        return chunk_by_words(text, chunk_size, overlap)
-    
-    # Use sentence-based chunking
-    logger.info(f"Using sentence-based chunking with {len(sentences)} sentences")
-    return chunk_by_sentences(sentences, chunk_size, overlap)
+    return list(iter_chunks([text], chunk_size, overlap))
 
-def chunk_by_sentences(sentences: List[str], chunk_size: int, overlap: int) -> List[str]:
-    """Chunk text by sentences while respecting size limits"""
-    chunks = []
+def iter_chunks(segments: Iterable[str], chunk_size: int = 500, overlap: int = 50) -> Iterator[str]:
+    """Chunk a stream of text segments (e.g. PDF pages) by sentences without materializing the whole text"""
+    # buffer holds cleaned text from the start of the current chunk onwards. Sentences are
+    # tracked as (start, end, word count) spans into it and text is only sliced out when a
+    # chunk is emitted, so sentences and overlap are never copied into separate strings
+    buffer = ""
+    # Segments with no sentence end yet (tables, lists) wait here and are joined onto the
+    # buffer once, when one arrives, instead of re-copying and re-scanning it every segment
+    pending = []
     current_chunk = []
     current_size = 0
+    sentence_start = 0
+    num_sentences = 0
+    num_chunks = 0
     
-    for sentence in sentences:
-        sentence_size = len(sentence.split())
+    # None marks the end of the stream, which completes the last sentence
+    for segment in chain(segments, [None]):
+        if segment is not None:
+            cleaned = clean_text(segment)
+            if not cleaned:
+                continue
+            # A sentence ends inside this segment, or at its join with the text before it
+            ends_at_join = (pending[-1] if pending else buffer).endswith(('.', '!', '?'))
+            if not ends_at_join and not SENTENCE_END_RE.search(cleaned):
+                pending.append(cleaned)
+                continue
+            pending.append(cleaned)
+            buffer = " ".join([buffer, *pending] if buffer else pending)
+            pending = []
+            # Earlier text holds no unseen sentence end, so scan from the character before the join
+            scan_from = max(sentence_start, len(buffer) - len(cleaned) - 2)
+            ends = [match.start() + 1 for match in SENTENCE_END_RE.finditer(buffer, scan_from)]
+        else:
+            if pending:
+                buffer = " ".join([buffer, *pending] if buffer else pending)
+            ends = [len(buffer)] if sentence_start < len(buffer) else []
         
-        # If adding this sentence would exceed chunk size
-        if current_size + sentence_size > chunk_size and current_chunk:
-            # Save current chunk
-            chunk_text = " ".join(current_chunk)
-            if chunk_text.strip():
-                chunks.append(chunk_text)
+        for end in ends:
+            # Cleaned text is single-spaced, so words = spaces + 1
+            sentence = (sentence_start, end, buffer.count(' ', sentence_start, end) + 1)
+            sentence_start = end + 1
+            num_sentences += 1
             
-            # Start new chunk with overlap
-            overlap_sentences = current_chunk[-2:] if len(current_chunk) >= 2 else current_chunk
-            current_chunk = overlap_sentences + [sentence]
-            current_size = sum(len(s.split()) for s in current_chunk)
-        else:
-            # Add sentence to current chunk
-            current_chunk.append(sentence)
-            current_size += sentence_size
+            # If adding this sentence would exceed chunk size
+            if current_size + sentence[2] > chunk_size and current_chunk:
+                # Emit current chunk
+                yield buffer[current_chunk[0][0]:current_chunk[-1][1]]
+                num_chunks += 1
+                
+                # Start new chunk with overlap (last two sentences)
+                current_chunk = current_chunk[-2:] + [sentence]
+                current_size = sum(words for _, _, words in current_chunk)
+            else:
+                # Add sentence to current chunk
+                current_chunk.append(sentence)
+                current_size += sentence[2]
+        
+        # Drop text before the current chunk so the buffer stays bounded
+        cut = current_chunk[0][0] if current_chunk else sentence_start
+        if cut:
+            buffer = buffer[cut:]
+            current_chunk = [(start - cut, end - cut, words) for start, end, words in current_chunk]
+            sentence_start -= cut
     
-    # Add final chunk
-    if current_chunk:
-        chunk_text = " ".join(current_chunk)
-        if chunk_text.strip():
-            chunks.append(chunk_text)
+    if num_sentences <= 1:
+        # Fallback to word-based chunking
+        if buffer:
+            logger.info("Using word-based chunking")
+            yield from chunk_by_words(buffer, chunk_size, overlap)
+        else:
+            logger.warning("Empty text provided for chunking")
+        return
     
-    logger.info(f"Created {len(chunks)} chunks from {len(sentences)} sentences")
-    return chunks
+    # Emit final chunk
+    yield buffer[current_chunk[0][0]:current_chunk[-1][1]]
+    logger.info(f"Created {num_chunks + 1} chunks from {num_sentences} sentences")
 
 def chunk_by_words(text: str, chunk_size: int, overlap: int) -> List[str]:
     """Fallback word-based chunking"""
+    # Text is whitespace-normalized by clean_text, so word i starts at starts[i]
+    # and each chunk is a single slice of the text rather than a re-join of words
     words = text.split()
+    starts = [0, *accumulate(len(word) + 1 for word in words)]
     chunks = []
     
     for i in range(0, len(words), chunk_size - overlap):
-        chunk = " ".join(words[i:i + chunk_size])
-        if chunk.strip():
-            chunks.append(chunk)
+        end = min(i + chunk_size, len(words))
+        chunks.append(text[starts[i]:starts[end] - 1])
     
     logger.info(f"Created {len(chunks)} word-based chunks")
     return chunks
 
 def validate_chunks(chunks: List[str]) -> List[str]:
     """Validate and filter chunks"""
-    valid_chunks = []
-    for i, chunk in enumerate(chunks):
-        if chunk and len(chunk.strip()) > 10:  # Minimum meaningful chunk size
-            valid_chunks.append(chunk)
-        else:
-            logger.warning(f"Removed invalid chunk {i}: too short or empty")
+    # Strip each chunk once, then keep those above the minimum meaningful chunk size
+    stripped = [chunk.strip() for chunk in chunks if chunk]
+    valid_chunks = [chunk for chunk in stripped if len(chunk) > 10]
+    
+    removed = len(chunks) - len(valid_chunks)
+    if removed:
+        logger.warning(f"Removed {removed} invalid chunks: too short or empty")
     
     logger.info(f"Validated {len(valid_chunks)} chunks from {len(chunks)} total")
-    return valid_chunks 
\ No newline at end of file
+    return valid_chunks
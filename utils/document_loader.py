@@ -1,16 +1,48 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import tempfile
 import os
 import logging
-from typing import Optional
+import mmap
+import threading
+from typing import Iterator, List, Optional
 from urllib.parse import urlparse
 import mimetypes
 from PyPDF2 import PdfReader
-import docx
 import json
+import zipfile
+from lxml import etree
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
 
 logger = logging.getLogger(__name__)
 
+# PDFium is not thread-safe, and documents are parsed on threads when there is no process
+# pool, so every pypdfium2 call (open, page count, text, close) goes through this lock
+pdfium_lock = threading.Lock()
+
+MAX_DOWNLOAD_SIZE = 50 * 1024 * 1024  # 50MB limit for Vercel
+DOWNLOAD_CHUNK_SIZE = 128 * 1024  # Streaming throughput plateaus around 100KB reads
+
+def create_session() -> requests.Session:
+    """Create a pooled HTTP session that keeps connections alive and retries transient failures"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Shared across calls so repeat downloads from a host skip the TCP and TLS handshakes
+session = create_session()
+
 class DocumentLoadError(Exception):
     """Custom exception for document loading errors"""
     pass
@@ -23,88 +55,179 @@ def get_file_extension(url: str) -> str:
         return path.split('.')[-1]
     return ''
 
-def get_content_type(url: str) -> Optional[str]:
-    """Get content type from URL or headers"""
+# Content types implied by a URL's file extension; these need no network lookup
+EXTENSION_CONTENT_TYPES = {
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'txt': 'text/plain',
+    'json': 'application/json',
+    'eml': 'message/rfc822'
+}
+
+def get_content_type(url: str, header: Optional[str] = None) -> Optional[str]:
+    """Get content type from the URL extension, falling back to the Content-Type header"""
+    content_type = EXTENSION_CONTENT_TYPES.get(get_file_extension(url))
+    if content_type:
+        return content_type
+    
+    # Only probe the server when no response header was passed in
+    if header is None:
+        try:
+            header = session.head(url, timeout=10).headers.get('content-type')
+        except Exception as e:
+            logger.warning(f"Could not get content type for {url}: {e}")
+    if header:
+        # Drop parameters such as "; charset=utf-8"
+        return header.split(';')[0].strip().lower()
+    return None
+
+def open_pdf(path: str):
+    """Open a PDF with pypdfium2 (C PDFium backend) when installed, falling back to PyPDF2"""
+    if pdfium is not None:
+        try:
+            with pdfium_lock:
+                return pdfium.PdfDocument(path)
+        except Exception as e:
+            logger.warning(f"pypdfium2 could not open PDF, falling back to PyPDF2: {e}")
+    return PdfReader(path)
+
+def count_pages(pdf) -> int:
+    """Number of pages in a PDF opened by open_pdf"""
+    if isinstance(pdf, PdfReader):
+        return len(pdf.pages)
+    with pdfium_lock:
+        return len(pdf)
+
+def close_pdf(pdf):
+    """Release the native resources of a PDF opened by open_pdf"""
+    if not isinstance(pdf, PdfReader):
+        with pdfium_lock:
+            pdf.close()
+
+def extract_page_text(pdf, i: int) -> Optional[str]:
+    """Extract the text of one PDF page, or None if it has none"""
     try:
-        response = requests.head(url, timeout=10)
-        content_type = response.headers.get('content-type', '').lower()
-        if content_type:
-            return content_type
+        if isinstance(pdf, PdfReader):
+            page_text = pdf.pages[i].extract_text()
+        else:
+            with pdfium_lock:
+                page = pdf[i]
+                try:
+                    textpage = page.get_textpage()
+                    try:
+                        page_text = textpage.get_text_range()
+                    finally:
+                        textpage.close()
+                finally:
+                    page.close()
     except Exception as e:
-        logger.warning(f"Could not get content type for {url}: {e}")
-    
-    # Fallback to URL extension
-    ext = get_file_extension(url)
-    if ext == 'pdf':
-        return 'application/pdf'
-    elif ext == 'docx':
-        return 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-    elif ext == 'txt':
-        return 'text/plain'
-    elif ext == 'json':
-        return 'application/json'
+        logger.warning(f"Failed to extract text from page {i}: {e}")
+        return None
+    if page_text and page_text.strip():
+        return page_text
     return None
 
-def parse_pdf(path: str) -> str:
-    """Parse PDF file with error handling"""
+def get_document_version(url: str) -> Optional[str]:
+    """Get the validator (ETag, else Last-Modified) identifying the current version of a document"""
     try:
-        reader = PdfReader(path)
-        text_parts = []
-        for i, page in enumerate(reader.pages):
-            try:
-                page_text = page.extract_text()
-                if page_text and page_text.strip():
-                    text_parts.append(page_text)
-            except Exception as e:
-                logger.warning(f"Failed to extract text from page {i}: {e}")
-        return " ".join(text_parts)
+        response = session.head(url, timeout=10, allow_redirects=True)
+        response.raise_for_status()
     except Exception as e:
-        raise DocumentLoadError(f"Failed to parse PDF: {e}")
+        logger.warning(f"Could not get document version for {url}: {e}")
+        return None
+    return response.headers.get('etag') or response.headers.get('last-modified')
 
-def parse_docx(path: str) -> str:
-    """Parse DOCX file with error handling"""
+def iter_pdf_pages(path: str) -> Iterator[str]:
+    """Yield the text of each PDF page as it is extracted"""
     try:
-        doc = docx.Document(path)
-        text_parts = []
-        for para in doc.paragraphs:
-            if para.text and para.text.strip():
-                text_parts.append(para.text)
-        return " ".join(text_parts)
+        pdf = open_pdf(path)
+        num_pages = count_pages(pdf)
     except Exception as e:
+        raise DocumentLoadError(f"Failed to parse PDF: {e}")
+    
+    try:
+        for i in range(num_pages):
+            page_text = extract_page_text(pdf, i)
+            if page_text:
+                yield page_text
+    finally:
+        close_pdf(pdf)
+
+def parse_pdf(path: str) -> str:
+    """Parse PDF file with error handling"""
+    return " ".join(iter_pdf_pages(path))
+
+# WordprocessingML elements read straight from word/document.xml
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+WORD_PARAGRAPH = WORD_NS + 'p'
+WORD_TEXT = WORD_NS + 't'
+WORD_BREAKS = {WORD_NS + 'tab': '\t', WORD_NS + 'br': '\n', WORD_NS + 'cr': '\n'}
+# Text boxes are stored twice, as a DrawingML mc:Choice and a legacy VML mc:Fallback copy
+MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+
+def iter_docx_paragraphs(path: str) -> Iterator[str]:
+    """Yield the text of each non-empty DOCX paragraph (text boxes before the paragraph holding them), streaming the document XML"""
+    try:
+        with zipfile.ZipFile(path) as archive, archive.open('word/document.xml') as xml:
+            for _, element in etree.iterparse(xml, events=('end',), tag=WORD_PARAGRAPH):
+                text = "".join(
+                    (node.text or "") if node.tag == WORD_TEXT else WORD_BREAKS[node.tag]
+                    for node in element.iter(WORD_TEXT, *WORD_BREAKS)
+                )
+                # Read text boxes from the mc:Choice copy only
+                duplicate = next(element.iterancestors(MC_FALLBACK), None) is not None
+                # Free parsed paragraphs so memory stays bounded on large documents
+                element.clear()
+                parent = element.getparent()
+                while parent is not None and element.getprevious() is not None:
+                    del parent[0]
+                if text.strip() and not duplicate:
+                    yield text
+    except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError) as e:
         raise DocumentLoadError(f"Failed to parse DOCX: {e}")
 
+def parse_docx(path: str) -> str:
+    """Parse DOCX file with error handling"""
+    return " ".join(iter_docx_paragraphs(path))
+
 def parse_txt(path: str) -> str:
     """Parse text file with error handling"""
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return f.read()
-    except UnicodeDecodeError:
-        try:
-            with open(path, 'r', encoding='latin-1') as f:
-                return f.read()
-        except Exception as e:
-            raise DocumentLoadError(f"Failed to parse text file: {e}")
+        # mmap can't map an empty file
+        if os.path.getsize(path) == 0:
+            return ""
+        # Decode straight from a memory map, so the file is never also held as a bytes copy
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            try:
+                return str(mm, 'utf-8')
+            except UnicodeDecodeError:
+                return str(mm, 'latin-1')
     except Exception as e:
         raise DocumentLoadError(f"Failed to parse text file: {e}")
 
+def walk_json(value, parts: List[str]):
+    """Append the text of every key and leaf value of a parsed JSON document to parts"""
+    if isinstance(value, str):
+        parts.append(value)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            parts.append(f"{key}:")
+            walk_json(item, parts)
+    elif isinstance(value, list):
+        for item in value:
+            walk_json(item, parts)
+    elif value is not None:
+        parts.append(str(value))
+
 def parse_json(path: str) -> str:
     """Parse JSON file and extract text content"""
     try:
         with open(path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-            # Try to extract text from common JSON structures
-            if isinstance(data, dict):
-                text_parts = []
-                for key, value in data.items():
-                    if isinstance(value, str):
-                        text_parts.append(f"{key}: {value}")
-                    elif isinstance(value, (dict, list)):
-                        text_parts.append(f"{key}: {json.dumps(value)}")
-                return " ".join(text_parts)
-            elif isinstance(data, list):
-                return " ".join(str(item) for item in data)
-            else:
-                return str(data)
+        # Collect leaf text in one pass and join once, rather than re-serializing nested values
+        parts = []
+        walk_json(data, parts)
+        return " ".join(parts)
     except Exception as e:
         raise DocumentLoadError(f"Failed to parse JSON: {e}")
 
@@ -121,8 +244,8 @@ def parse_email(path: str) -> str:
     except Exception as e:
         raise DocumentLoadError(f"Failed to parse email: {e}")
 
-def download_and_parse_document(url: str) -> str:
-    """Download and parse document with comprehensive error handling"""
+def iter_document_text(url: str) -> Iterator[str]:
+    """Download a document and yield its text segment by segment (pages, paragraphs)"""
     logger.info(f"Downloading document from: {url}")
     
     # Validate URL
@@ -134,52 +257,58 @@ def download_and_parse_document(url: str) -> str:
         headers = {
             'User-Agent': 'HackRx-Document-Loader/1.0'
         }
-        response = requests.get(url, headers=headers, timeout=30, stream=True)
+        response = session.get(url, headers=headers, timeout=30, stream=True)
         response.raise_for_status()
         
         # Check file size (limit to 50MB for Vercel)
         content_length = response.headers.get('content-length')
-        if content_length and int(content_length) > 50 * 1024 * 1024:
+        if content_length and int(content_length) > MAX_DOWNLOAD_SIZE:
+            response.close()
             raise DocumentLoadError("File too large (max 50MB)")
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(response.content)
-            tmp_path = tmp.name
+        # Stream the body straight to a temporary file, never holding all of it in memory
+        tmp_fd, tmp_path = tempfile.mkstemp()
         
         try:
-            # Determine file type and parse
-            content_type = get_content_type(url)
+            with os.fdopen(tmp_fd, 'wb') as tmp, response:
+                size = 0
+                for block in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    size += len(block)
+                    # Content-Length may be missing or wrong, so enforce the limit while streaming
+                    if size > MAX_DOWNLOAD_SIZE:
+                        raise DocumentLoadError("File too large (max 50MB)")
+                    tmp.write(block)
+            
+            # Determine file type from the extension or the GET response, with no extra request
+            content_type = get_content_type(url, response.headers.get('content-type', ''))
             file_extension = get_file_extension(url)
             
             logger.info(f"File type: {content_type}, extension: {file_extension}")
             
             # Parse based on content type or extension
             if content_type == 'application/pdf' or file_extension == 'pdf':
-                text = parse_pdf(tmp_path)
+                segments = iter_pdf_pages(tmp_path)
             elif content_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document' or file_extension == 'docx':
-                text = parse_docx(tmp_path)
+                segments = iter_docx_paragraphs(tmp_path)
             elif content_type == 'text/plain' or file_extension == 'txt':
-                text = parse_txt(tmp_path)
+                segments = [parse_txt(tmp_path)]
             elif content_type == 'application/json' or file_extension == 'json':
-                text = parse_json(tmp_path)
-            elif file_extension == 'eml':
-                text = parse_email(tmp_path)
+                segments = [parse_json(tmp_path)]
+            elif content_type == 'message/rfc822' or file_extension == 'eml':
+                segments = [parse_email(tmp_path)]
             else:
-                # Try to guess from content
-                if response.content.startswith(b'%PDF'):
-                    text = parse_pdf(tmp_path)
-                elif 'PK' in response.content[:4]:  # ZIP/DOCX signature
-                    text = parse_docx(tmp_path)
+                # Try to guess from the first bytes of the downloaded file
+                with open(tmp_path, 'rb') as f:
+                    magic = f.read(8)
+                if magic.startswith(b'%PDF'):
+                    segments = iter_pdf_pages(tmp_path)
+                elif magic.startswith(b'PK\x03\x04'):  # ZIP/DOCX local file header
+                    segments = iter_docx_paragraphs(tmp_path)
                 else:
                     # Try as text
-                    text = parse_txt(tmp_path)
+                    segments = [parse_txt(tmp_path)]
             
-            if not text or not text.strip():
-                raise DocumentLoadError("No text content extracted from document")
-            
-            logger.info(f"Successfully parsed document, extracted {len(text)} characters")
-            return text.strip()
+            yield from segments
             
         finally:
             # Clean up temporary file
@@ -191,4 +320,14 @@ def download_and_parse_document(url: str) -> str:
     except requests.exceptions.RequestException as e:
         raise DocumentLoadError(f"Failed to download document: {e}")
     except Exception as e:
-        raise DocumentLoadError(f"Failed to process document: {e}") 
\ No newline at end of file
+        raise DocumentLoadError(f"Failed to process document: {e}")
+
+def download_and_parse_document(url: str) -> str:
+    """Download and parse document with comprehensive error handling"""
+    text = " ".join(iter_document_text(url))
+    
+    if not text or not text.strip():
+        raise DocumentLoadError("No text content extracted from document")
+    
+    logger.info(f"Successfully parsed document, extracted {len(text)} characters")
+    return text.strip()
@@ -1,34 +1,58 @@
 import re
-from collections import Counter
+import zlib
+from itertools import islice
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import logging
+import threading
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 
 # Use a lightweight model that works well on Vercel
 MODEL_NAME = "all-MiniLM-L6-v2"  # Small, fast, good performance
-model = None
+EMBED_BATCH_SIZE = 64  # Chunks per encoder forward pass
+# Chunks handed to each encode() call. encode() sorts its inputs by length before
+# splitting them into forward passes, so a window of several batches keeps padding low
+EMBED_SORT_WINDOW = 4 * EMBED_BATCH_SIZE
+# Compiled once; simple_embed and text cleaning run for every chunk
+TOKEN_RE = re.compile(r'\w+')
+WHITESPACE_RE = re.compile(r'\s+')
+HASHED_EMBED_DIM = 4096  # Buckets of the hashed bag-of-words fallback embedding (a power of two)
+model = None  # False once loading has failed, so the fallback is used without retrying
+# Embedding runs in executor threads, so guard the lazy load
+model_lock = threading.Lock()
 
 def get_model():
     """Lazy load the model to avoid memory issues on Vercel"""
     global model
     if model is None:
-        try:
-            model = SentenceTransformer(MODEL_NAME)
-            logger.info(f"Loaded sentence transformer model: {MODEL_NAME}")
-        except Exception as e:
-            logger.error(f"Failed to load sentence transformer: {e}")
-            # Fallback to simple embedding
-            return None
-    return model
+        with model_lock:
+            if model is None:
+                try:
+                    loaded = SentenceTransformer(MODEL_NAME)
+                    # One dummy encode warms up torch kernels before the first real request
+                    loaded.encode(["warmup"], convert_to_numpy=True, show_progress_bar=False)
+                    model = loaded
+                    logger.info(f"Loaded sentence transformer model: {MODEL_NAME}")
+                except Exception as e:
+                    logger.error(f"Failed to load sentence transformer: {e}")
+                    # Fallback to simple embedding from now on
+                    model = False
+    return model if model is not False else None
+
+def warm_up_model() -> bool:
+    """Load and warm up the model ahead of the first request; False if it is unavailable"""
+    return get_model() is not None
 
 def simple_embed(text):
-    """Simple word frequency embedding as fallback"""
-    words = re.findall(r'\b\w+\b', text.lower())
-    word_freq = Counter(words)
-    return word_freq
+    """Hashed bag-of-words embedding as fallback, L2-normalized like the model's"""
+    words = TOKEN_RE.findall(text.lower())
+    # crc32 rather than hash(), which is salted per process and would differ between pool workers
+    buckets = [zlib.crc32(word.encode()) & (HASHED_EMBED_DIM - 1) for word in words]
+    embedding = np.bincount(buckets, minlength=HASHED_EMBED_DIM).astype(np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
 
 def embed_text(text):
     """Embed text using sentence transformers or fallback to simple embedding"""
@@ -36,7 +60,7 @@ def embed_text(text):
         model = get_model()
         if model:
             # Clean and truncate text for better embedding
-            cleaned_text = re.sub(r'\s+', ' ', text.strip())
+            cleaned_text = WHITESPACE_RE.sub(' ', text.strip())
             if len(cleaned_text) > 512:  # Truncate for model efficiency
                 cleaned_text = cleaned_text[:512]
             embedding = model.encode(cleaned_text)
@@ -48,43 +72,76 @@ def embed_text(text):
         logger.warning(f"Embedding failed, using fallback: {e}")
         return simple_embed(text)
 
+def iter_batches(items, batch_size):
+    """Yield lists of up to batch_size items from any iterable"""
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def embed_batch(texts):
+    """Embed a window of texts with a single encoder call, in length-sorted forward passes"""
+    model = get_model()
+    if not model:
+        return [simple_embed(text) for text in texts]
+    try:
+        # Clean and truncate text for better embedding
+        cleaned = [WHITESPACE_RE.sub(' ', text.strip())[:512] for text in texts]
+        embeddings = model.encode(
+            cleaned,
+            batch_size=EMBED_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        return list(embeddings)
+    except Exception as e:
+        logger.error(f"Failed to embed batch of {len(texts)} chunks: {e}")
+        # Add zero embeddings as fallback
+        return [np.zeros(model.get_sentence_embedding_dimension(), dtype=np.float32) for _ in texts]
+
 def embed_chunks(chunks):
-    """Create embeddings for chunks"""
+    """Create embeddings for chunks, consuming any iterable in fixed-size windows"""
     embeddings = []
-    for i, chunk in enumerate(chunks):
-        try:
-            embedding = embed_text(chunk)
-            embeddings.append(embedding)
-            if i % 10 == 0:  # Log progress every 10 chunks
-                logger.info(f"Embedded {i+1}/{len(chunks)} chunks")
-        except Exception as e:
-            logger.error(f"Failed to embed chunk {i}: {e}")
-            # Add zero embedding as fallback
-            embeddings.append([0.0] * 384 if isinstance(embed_text("test"), list) else {})
+    for batch in iter_batches(chunks, EMBED_SORT_WINDOW):
+        embeddings.extend(embed_batch(batch))
+        logger.info(f"Embedded {len(embeddings)} chunks")
     return embeddings
 
 def embed_query(query):
     """Create embedding for query"""
     return embed_text(query)
 
+def embed_queries(queries):
+    """Create embeddings for all queries in a single batched encoder call"""
+    try:
+        model = get_model()
+        if model:
+            # Same cleaning/truncation as embed_text, applied to the whole batch
+            cleaned = [WHITESPACE_RE.sub(' ', q.strip())[:512] for q in queries]
+            # encode() sorts by length internally to minimise padding, then restores order
+            embeddings = model.encode(
+                cleaned,
+                batch_size=EMBED_BATCH_SIZE,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+            return np.asarray(embeddings, dtype=np.float32)
+        else:
+            return np.vstack([simple_embed(q) for q in queries])
+    except Exception as e:
+        logger.warning(f"Batch query embedding failed, using fallback: {e}")
+        return np.vstack([simple_embed(q) for q in queries])
+
 def cosine_similarity(vec1, vec2):
     """Calculate cosine similarity between two vectors"""
     try:
-        if isinstance(vec1, dict) and isinstance(vec2, dict):
-            # Simple word overlap for dict embeddings
-            words1 = set(vec1.keys())
-            words2 = set(vec2.keys())
-            intersection = len(words1.intersection(words2))
-            union = len(words1.union(words2))
-            return intersection / union if union > 0 else 0
-        else:
-            # Cosine similarity for vector embeddings
-            vec1 = np.array(vec1)
-            vec2 = np.array(vec2)
-            dot_product = np.dot(vec1, vec2)
-            norm1 = np.linalg.norm(vec1)
-            norm2 = np.linalg.norm(vec2)
-            return dot_product / (norm1 * norm2) if norm1 * norm2 > 0 else 0
+        vec1 = np.asarray(vec1)
+        vec2 = np.asarray(vec2)
+        dot_product = np.dot(vec1, vec2)
+        norm1 = np.linalg.norm(vec1)
+        norm2 = np.linalg.norm(vec2)
+        return dot_product / (norm1 * norm2) if norm1 * norm2 > 0 else 0
     except Exception as e:
         logger.error(f"Similarity calculation failed: {e}")
         return 0.0 
\ No newline at end of file
@@ -1,35 +1,77 @@
-from utils.embedder import cosine_similarity
+import io
+import numpy as np
 import logging
 
 logger = logging.getLogger(__name__)
 
+def stack_rows(embeddings):
+    """Copy embeddings into a new contiguous float32 matrix, one row per embedding"""
+    return np.ascontiguousarray(np.vstack(embeddings), dtype=np.float32)
+
+def normalize_rows(matrix):
+    """L2-normalize each row of a float32 matrix in place so inner product equals cosine similarity"""
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return matrix
+
 def build_faiss_index(embeddings):
-    """Build simple index - just return the embeddings"""
+    """Build index - a normalized float32 matrix, searched exactly"""
+    # MAX_TEXT_LENGTH caps a document at a few hundred chunks, where an exact matmul beats any
+    # approximate index. Kept as contiguous float32 so searching is a single BLAS call with no upcast
+    matrix = normalize_rows(stack_rows(embeddings))
     logger.info(f"Built index with {len(embeddings)} embeddings")
-    return embeddings
+    return matrix
+
+def serialize_index(index) -> bytes:
+    """Serialize a matrix index to bytes"""
+    # Stored as float16 to halve the cache size; upcast once when loaded
+    buffer = io.BytesIO()
+    np.save(buffer, index.astype(np.float16), allow_pickle=False)
+    return buffer.getvalue()
+
+def deserialize_index(data):
+    """Inverse of serialize_index"""
+    return np.load(io.BytesIO(data), allow_pickle=False).astype(np.float32)
+
+def top_k_rows(scores, k):
+    """Column indices of the k highest scores in each row, best first"""
+    n = scores.shape[1]
+    k = min(k, n)
+    if k < n:
+        # O(N) selection of the top k, then only those k are sorted. Partitioning at n - k
+        # puts the k largest last, without allocating a negated copy of the scores
+        top_indices = np.argpartition(scores, n - k, axis=1)[:, n - k:]
+    else:
+        top_indices = np.broadcast_to(np.arange(k), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, top_indices, axis=1), axis=1)
+    return np.take_along_axis(top_indices, order, axis=1)
 
-def retrieve_top_k_chunks(index, query_embedding, chunks, k=5):
-    """Retrieve top k chunks using cosine similarity"""
+def save_index(index, path):
+    """Write a matrix index to disk"""
+    with open(path, 'wb') as f:
+        np.save(f, index, allow_pickle=False)
+
+def load_index(path):
+    """Memory-map an index written by save_index, so loading it costs no copy"""
+    return np.load(path, mmap_mode='r', allow_pickle=False)
+
+def search_dense(index, query_embeddings, k):
+    """Score all queries against the matrix index in one matmul"""
+    queries = normalize_rows(stack_rows(query_embeddings))
+    scores = queries @ index.T
+    top_indices = top_k_rows(scores, k)
+    return np.take_along_axis(scores, top_indices, axis=1), top_indices
+
+def retrieve_top_k_chunks(index, query_embeddings, chunks, k=5):
+    """Retrieve top k chunks for every query using cosine similarity"""
     try:
-        similarities = []
-        for i, chunk_embedding in enumerate(index):
-            try:
-                similarity = cosine_similarity(query_embedding, chunk_embedding)
-                similarities.append((similarity, i))
-            except Exception as e:
-                logger.warning(f"Failed to calculate similarity for chunk {i}: {e}")
-                similarities.append((0.0, i))
-        
-        # Sort by similarity (descending) and get top k
-        similarities.sort(reverse=True)
-        top_indices = [i for _, i in similarities[:k]]
-        
+        top_similarities, top_indices = search_dense(index, query_embeddings, k)
+
         # Log retrieval stats
-        top_similarities = [sim for sim, _ in similarities[:k]]
-        logger.info(f"Retrieved {len(top_indices)} chunks with similarities: {top_similarities}")
-        
-        return [chunks[i] for i in top_indices]
+        for sims, indices in zip(top_similarities, top_indices):
+            logger.info(f"Retrieved {len(indices)} chunks with similarities: {list(sims)}")
+
+        return [[chunks[i] for i in indices] for indices in top_indices]
     except Exception as e:
         logger.error(f"Retrieval failed: {e}")
         # Return first k chunks as fallback
-        return chunks[:k] if chunks else [] 
\ No newline at end of file
+        return [chunks[:k] if chunks else [] for _ in query_embeddings]
@@ -93,14 +93,16 @@ def generate_answer_with_retry(question: str, context: str, max_retries: int = M
                 time.sleep(RETRY_DELAY * (attempt + 1))  # Exponential backoff
             else:
                 logger.error(f"All LLM attempts failed: {e}")
-                return f"I apologize, but I encountered an error while processing your question. Please try again. Error: {str(e)}"
+                raise LLMError(str(e)) from e
     
-    return "I apologize, but I was unable to generate an answer. Please try again."
+    raise LLMError("Unable to generate an answer")
 
 def generate_answer(question: str, context: str) -> str:
     """Main function to generate answer - wrapper for retry logic"""
     try:
         return generate_answer_with_retry(question, context)
+    except LLMError as e:
+        return f"I apologize, but I encountered an error while processing your question. Please try again. Error: {str(e)}"
     except Exception as e:
         logger.error(f"Unexpected error in generate_answer: {e}")
         return f"I apologize, but I encountered an unexpected error: {str(e)}"